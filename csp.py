@@ -1,4 +1,5 @@
 from collections import deque
+import heapq
 import random
 from collections import defaultdict
 
@@ -16,6 +17,8 @@ class Csp:
         self._domains = domains
         self._constraints = constraints
         self._queue = deque()
+        # values removed from the domains during the backtracking search (None when the search is not running)
+        self._trail = None
         
             
             
@@ -73,6 +76,10 @@ class Csp:
         for value in valrem:
             self._domains[Xi].discard(value)
 
+        # during the backtracking search the removed values are recorded, so they can be restored when backtracking
+        if valrem and self._trail is not None:
+            self._trail.append((Xi, valrem))
+
         return updatedDomainXi
 
     def recheckArcs(self, var_updated):
@@ -200,120 +207,183 @@ class Csp:
         """
         solutions = []
         assignment = {v: False for v in self._domains.keys()}
+        self._initHeuristics()
         self._backtrackingSearch(solutions, self.degreeHeuristic, self.lcvHeuristic, assignment)
+        self._trail = None
         return solutions
 
     
 
     def _backtrackingSearch(self, solutions, variableHeuristic, valueHeuristic, assignment):
         """
-        Auxiliary function that performs the backtracking search algorithm for CSP. It returns a list of dictionary in which there is a key for each variable linked to its value in a possible solution for the CSP 
+        Auxiliary function that performs the backtracking search algorithm for CSP. It returns a list of dictionary in which there is a key for each variable linked to its value in a possible solution for the CSP.
+        Instead of copying all the domains at every node, the values removed by AC-3 are recorded in self._trail and put back when the search backtracks, so a node only costs the changes it makes
         """
-        if all(assignment[v] is not False for v in assignment):
+        if self._numUnassigned == 0:
             solutions.append(assignment.copy())
             return
 
-
-
-        # deep copy of the current domains
-        current_domains = {v: set(d) for v, d in self._domains.items()}
-
-        
         # choosing the variable to assing
         var = variableHeuristic(assignment)
         if var is None:
             return
 
-        domain_values = deque()
-        var_domain = self._domains[var].copy()
-        while var_domain:
-            val = valueHeuristic(assignment, var, var_domain)
-            domain_values.append(val)
-            var_domain.discard(val)
+        # the values of var are scored once and sorted by the value heuristic
+        domain_values = valueHeuristic(assignment, var, self._domains[var])
+        self._markAssigned(var)
 
-        while domain_values:
-            curvalue = domain_values.popleft()
+        for curvalue in domain_values:
             assignment[var] = curvalue
-            self._domains = {v: set(d) for v, d in current_domains.items()}
-            self._domains[var] = {curvalue}
+            mark = len(self._trail)
+            removed = self._domains[var] - {curvalue}
+            if removed:
+                self._domains[var].difference_update(removed)
+                self._trail.append((var, removed))
             queue = self._macQueue(assignment, var)
             domains_after_ac3, flag = self.runAc3(queue=queue)
             if flag:
+                self._pushDomainSizes(assignment, mark)
                 self._backtrackingSearch(solutions, self.mrvHeuristic, self.lcvHeuristic, assignment)
-
+            self._restoreDomains(assignment, mark, flag)
 
         assignment[var] = False
-        self._domains = current_domains
+        self._markUnassigned(var)
+        self._pushDomainSize(var)
 
 
     def _macQueue(self, assignment, var):
 
-        unassigned = [v for v in assignment if not assignment[v]]
         queue = deque()
-        for (Xi, Xj) in self._arcs:
-            if Xj == var and Xi in unassigned:
-                queue.append((Xi, Xj))
+        for Xi in self._inNeighbors[var]:
+            if assignment[Xi] is False:
+                queue.append((Xi, var))
 
         return queue
 
+
+    def _initHeuristics(self):
+        """
+        Builds the bookkeeping used by the heuristics during the backtracking search: the neighbors of each variable, the number of constraints
+        that each variable shares with the unassigned variables (degree heuristic) and a heap of domain sizes (MRV heuristic).
+        These structures are then updated incrementally when a variable is assigned and when a domain shrinks or is restored
+        """
+        # neighbors[Xi] = variables Xj such that (Xi, Xj) is an arc, inNeighbors[Xj] = variables Xi such that (Xi, Xj) is an arc
+        self._neighbors = defaultdict(list)
+        self._inNeighbors = defaultdict(list)
+        for (Xi, Xj) in self._arcs:
+            self._neighbors[Xi].append(Xj)
+            self._inNeighbors[Xj].append(Xi)
+
+        # at the beginning every variable is unassigned, so the degree is the number of constraints of the variable
+        self._degree = {v: 0 for v in self._domains}
+        for (Xi, Xj) in self._arcs:
+            self._degree[Xi] += len(self._constraints[(Xi, Xj)])
+
+        self._numUnassigned = len(self._domains)
+        self._trail = []
+        self._sizeHeap = []
+        for v in self._domains:
+            self._pushDomainSize(v)
+
+
+    def _markAssigned(self, var):
+        """
+        Updates the degree of the unassigned variables that share a constraint with var, because var is no longer unassigned
+        """
+        self._numUnassigned -= 1
+        for Xi in self._inNeighbors[var]:
+            self._degree[Xi] -= len(self._constraints[(Xi, var)])
+
+
+    def _markUnassigned(self, var):
+        self._numUnassigned += 1
+        for Xi in self._inNeighbors[var]:
+            self._degree[Xi] += len(self._constraints[(Xi, var)])
+
+
+    def _pushDomainSize(self, var):
+        """
+        Pushes the current domain size of var in the MRV heap. Old entries of var are not removed, they are discarded by mrvHeuristic when they don't match
+        the current size of the domain. The random number breaks the ties between variables with the same domain size
+        """
+        # rebuilding the heap when there are too many old entries, so that its size stays proportional to the number of variables
+        if len(self._sizeHeap) > 4 * len(self._domains):
+            self._sizeHeap = [(len(d), random.random(), v) for v, d in self._domains.items()]
+            heapq.heapify(self._sizeHeap)
+        heapq.heappush(self._sizeHeap, (len(self._domains[var]), random.random(), var))
+
+
+    def _pushDomainSizes(self, assignment, mark):
+        """
+        Pushes in the MRV heap the new domain size of the unassigned variables whose domain has been reduced after the position mark of the trail
+        """
+        for (v, removed) in self._trail[mark:]:
+            if assignment[v] is False:
+                self._pushDomainSize(v)
+
+
+    def _restoreDomains(self, assignment, mark, pushed):
+        """
+        Puts back in the domains the values removed after the position mark of the trail. If the reduced sizes have been pushed in the MRV heap,
+        the restored sizes are pushed too
+        """
+        while len(self._trail) > mark:
+            (v, removed) = self._trail.pop()
+            self._domains[v].update(removed)
+            if pushed and assignment[v] is False:
+                self._pushDomainSize(v)
+
     
     def degreeHeuristic(self, assignment):
         """ 
         This method returns an unassigned variable following the degree heuristic. This heuristic choose to assign a value to the variable involved in 
         the greatest number of constraints among other unassigned variables.
-        Assigned must be a dict where each key is a variable of the CSP and the value is the assigned value for the variable, or False is the variable is unassigned
+        Assigned must be a dict where each key is a variable of the CSP and the value is the assigned value for the variable, or False is the variable is unassigned.
+        The number of constraints of each variable is kept updated by _markAssigned and _markUnassigned
         """
-        num_constraints = {}
-
-        unassigned = [v for v in assignment if not assignment[v]]
+        unassigned = [v for v in assignment if assignment[v] is False]
 
         if not unassigned:
             return None
 
-        for v in unassigned:
-            num_constraints[v] = 0
-            for (Xi, Xj) in self._arcs:
-                if Xi == v and Xj in unassigned:
-                    num_constraints[Xi] += len(self._constraints[(Xi, Xj)])
-        max_degree = max(num_constraints.values())
-        bests = [v for v, deg in num_constraints.items() if deg == max_degree]
+        max_degree = max(self._degree[v] for v in unassigned)
+        bests = [v for v in unassigned if self._degree[v] == max_degree]
         return random.choice(bests)
     
     
     def mrvHeuristic(self, assignment): 
         """
-        Minimum Remaining Value heuristic. This method returns the unassigned variable that has the minimum remaining value in its domain
+        Minimum Remaining Value heuristic. This method returns the unassigned variable that has the minimum remaining value in its domain.
+        The entries of the heap that refer to assigned variables or to an old domain size are discarded
         """
-        unassigned = [k for k, v in assignment.items() if not v]
-        num_values = {}
-        for v in unassigned: 
-            num_values[v] = len(self._domains[v])
-        min_val = min(num_values.values())
-        bests = [k for k, v in num_values.items() if v == min_val]
-        return random.choice(bests)    
+        while self._sizeHeap:
+            (size, _, v) = heapq.heappop(self._sizeHeap)
+            if assignment[v] is False and size == len(self._domains[v]):
+                return v
+        return None
         
 
 
     def lcvHeuristic(self, assignment, var, domain):
         """
-        This method returns the value to be assigned to the variable var (the parameter one) in the current step of the backtracking search. The value the least constraining value, so the value that does not permit
-        the minimum number of assignment to other unassigned variables in the CSP
+        This method returns the values of the domain of the variable var (the parameter one) in the order in which they have to be tried in the current step of the backtracking search.
+        The values are ordered following the least constraining value heuristic, so the first value is the one that rules out the minimum number of values of the other unassigned variables in the CSP.
+        Each value is scored once, values with the same score are in random order
         """
-        unassigned = [v for v in assignment if not assignment[v]]
-        unassigned_neighbors = [Xj for (Xi, Xj) in self._arcs if Xi == var and Xj in unassigned]
-        num_constraint_for_values = defaultdict(int)
+        unassigned_neighbors = [Xj for Xj in self._neighbors[var] if assignment[Xj] is False]
+        num_constraint_for_values = {}
 
         for value in domain:
             num_constraint_for_values[value] = 0
-
-        for value in domain:
             for Xj in unassigned_neighbors:
                 for constraint in self._constraints[(var, Xj)]:
                     num_constraint_for_values[value] += sum([1 for value2 in self._domains[Xj] if not constraint(value, value2)])
 
-        min_constraints = min(num_constraint_for_values.values())
-        bests = [v for v, c in num_constraint_for_values.items() if c == min_constraints]
-        return random.choice(bests)
+        # the sort is stable, so shuffling first breaks the ties randomly
+        values = list(domain)
+        random.shuffle(values)
+        values.sort(key=lambda v: num_constraint_for_values[v])
+        return values
     
     
     